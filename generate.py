@@ -1,8 +1,56 @@
 #!/usr/bin/env python
 
-from __future__ import with_statement
-from string import Template
-import re, fnmatch, os, codecs, pickle
+from concurrent.futures import ThreadPoolExecutor
+import re, os, sys, codecs, pickle
+
+INITIALIZE = sys.intern('initialize')
+CLEANUP = sys.intern('cleanup')
+
+# The test-function scan is the hot path over every byte of every test
+# file; prefer RE2's linear-time engine for it when available. The
+# bindings disagree on stdlib flags (google-re2 rejects them outright,
+# others ignore them), so any compile failure or a probe showing that
+# ^ does not anchor per line falls back to the stdlib engine.
+TEST_FUNC_PATTERN = rb"^(void\s+(test_\w+__\w+)\(\s*void\s*\))\s*\{"
+
+try:
+    import re2
+    TEST_FUNC_REGEX = re2.compile(TEST_FUNC_PATTERN, re.MULTILINE)
+    if not TEST_FUNC_REGEX.search(b"int x;\nvoid test_re2__probe(void) {"):
+        raise ValueError("multiline anchoring not supported")
+except Exception:
+    TEST_FUNC_REGEX = re.compile(TEST_FUNC_PATTERN, re.MULTILINE)
+
+SKIP_COMMENTS_REGEX = re.compile(
+    rb'//.*?$|/\*.*?\*/|\'(?:\\.|[^\\\'])*\'|"(?:\\.|[^\\"])*"',
+    re.DOTALL | re.MULTILINE)
+
+def _comment_replacer(match):
+    s = match.group(0)
+    return b"" if s.startswith(b'/') else s
+
+def _c_files_in(root, module_root=None):
+    """Yield (directory, path components, [names of .c files]) for every
+    directory under root."""
+    if module_root is None:
+        module_root = []
+
+    # Like os.walk's default, skip directories we cannot read or that
+    # disappear mid-walk instead of aborting the whole scan.
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        entries = []
+
+    files = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            for subdir in _c_files_in(entry.path, module_root + [entry.name]):
+                yield subdir
+        elif entry.is_file() and entry.name.endswith(".c"):
+            files.append(entry.name)
+
+    yield root, module_root, files
 
 class Module(object):
     class Template(object):
@@ -16,33 +64,34 @@ class Module(object):
 
     class DeclarationTemplate(Template):
         def render(self):
-            out = "\n".join("extern %s;" % cb['declaration'] for cb in self.module.callbacks)
+            lines = ["extern %s;" % cb['declaration'] for cb in self.module.callbacks]
 
             if self.module.initialize:
-                out += "extern %s;\n" % self.module.initialize['declaration']
+                lines.append("extern %s;" % self.module.initialize['declaration'])
 
             if self.module.cleanup:
-                out += "extern %s;\n" % self.module.cleanup['declaration']
+                lines.append("extern %s;" % self.module.cleanup['declaration'])
 
-            return out
+            return "\n".join(lines) + "\n"
 
     class CallbacksTemplate(Template):
         def render(self):
-            out = "static const struct clar_func _clar_cb_%s[] = {\n" % self.module.name
-            out += ",\n".join(self._render_callback(cb) for cb in self.module.callbacks)
-            out += "\n};\n"
-            return out
+            return "".join((
+                "static const struct clar_func _clar_cb_%s[] = {\n" % self.module.name,
+                ",\n".join(self._render_callback(cb) for cb in self.module.callbacks),
+                "\n};\n"
+            ))
 
     class InfoTemplate(Template):
+        FORMAT = r"""{{
+                    "{clean_name}",
+                    {initialize},
+                    {cleanup},
+                    {cb_ptr}, {cb_count}, {enabled}
+                }}"""
+
         def render(self):
-            return Template(
-            r"""{
-                    "${clean_name}",
-                    ${initialize},
-                    ${cleanup},
-                    ${cb_ptr}, ${cb_count}, ${enabled}
-                }"""
-            ).substitute(
+            return self.FORMAT.format(
                 clean_name = self.module.clean_name(),
                 initialize = self._render_callback(self.module.initialize),
                 cleanup = self._render_callback(self.module.cleanup),
@@ -62,36 +111,42 @@ class Module(object):
         return self.name.replace("_", "::")
 
     def _skip_comments(self, text):
-        SKIP_COMMENTS_REGEX = re.compile(
-            r'//.*?$|/\*.*?\*/|\'(?:\\.|[^\\\'])*\'|"(?:\\.|[^\\"])*"',
-            re.DOTALL | re.MULTILINE)
+        return SKIP_COMMENTS_REGEX.sub(_comment_replacer, text)
 
-        def _replacer(match):
-            s = match.group(0)
-            return "" if s.startswith('/') else s
+    def parse(self, contents):
+        self.callbacks = []
+        self.initialize = None
+        self.cleanup = None
 
-        return re.sub(SKIP_COMMENTS_REGEX, _replacer, text)
+        try:
+            prefix = ("test_%s__" % self.name).encode('ascii')
+        except UnicodeEncodeError:
+            # A non-ASCII module name cannot match any C test symbol;
+            # drop the module like any other file without tests.
+            return False
 
-    def parse(self, contents):
-        TEST_FUNC_REGEX = r"^(void\s+(test_%s__(\w+))\(\s*void\s*\))\s*\{"
+        # Cheap substring test before stripping comments and scanning;
+        # files without any test functions never hit the regex engine.
+        if prefix not in contents:
+            return False
 
         contents = self._skip_comments(contents)
-        regex = re.compile(TEST_FUNC_REGEX % self.name, re.MULTILINE)
 
-        self.callbacks = []
-        self.initialize = None
-        self.cleanup = None
+        for match in TEST_FUNC_REGEX.finditer(contents):
+            symbol = match.group(2)
+            if not symbol.startswith(prefix):
+                continue
 
-        for (declaration, symbol, short_name) in regex.findall(contents):
+            short_name = sys.intern(symbol[len(prefix):].decode('ascii'))
             data = {
                 "short_name" : short_name,
-                "declaration" : declaration,
-                "symbol" : symbol
+                "declaration" : match.group(1).decode('ascii'),
+                "symbol" : symbol.decode('ascii')
             }
 
-            if short_name == 'initialize':
+            if short_name == INITIALIZE:
                 self.initialize = data
-            elif short_name == 'cleanup':
+            elif short_name == CLEANUP:
                 self.cleanup = data
             else:
                 self.callbacks.append(data)
@@ -102,19 +157,22 @@ class Module(object):
         self.modified = False
 
         try:
-            st = os.stat(path)
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                st = os.fstat(fd)
 
-            # Not modified
-            if st.st_mtime == self.mtime:
-                return True
+                # Not modified
+                if st.st_mtime == self.mtime:
+                    return True
 
-            self.modified = True
-            self.mtime = st.st_mtime
+                self.modified = True
+                self.mtime = st.st_mtime
 
-            with open(path) as fp:
-                raw_content = fp.read()
+                raw_content = os.read(fd, st.st_size)
+            finally:
+                os.close(fd)
 
-        except IOError:
+        except OSError:
             return False
 
         return self.parse(raw_content)
@@ -135,13 +193,8 @@ class TestSuite(object):
 
     def find_modules(self):
         modules = []
-        for root, _, files in os.walk(self.path):
-            module_root = root[len(self.path):]
-            module_root = [c for c in module_root.split(os.sep) if c]
-
-            tests_in_module = fnmatch.filter(files, "*.c")
-
-            for test_file in tests_in_module:
+        for root, module_root, files in _c_files_in(self.path):
+            for test_file in files:
                 full_path = os.path.join(root, test_file)
                 module_name = "_".join(module_root + [test_file[:-2]])
 
@@ -154,7 +207,7 @@ class TestSuite(object):
         cache = {}
 
         try:
-            fp = open(path)
+            fp = open(path, 'rb')
             cache = pickle.load(fp)
             fp.close()
         except IOError:
@@ -164,27 +217,41 @@ class TestSuite(object):
 
     def save_cache(self):
         path = os.path.join(self.path, '.clarcache')
-        with open(path, 'w') as cache:
+        with open(path, 'wb') as cache:
             pickle.dump(self.modules, cache)
 
     def load(self, force = False):
         module_data = self.find_modules()
         self.modules = {} if force else self.load_cache()
 
+        refreshes = {}
         for path, name in module_data:
             if name not in self.modules:
                 self.modules[name] = Module(name)
 
-            if not self.modules[name].refresh(path):
-                del self.modules[name]
+            # Distinct paths can collapse to the same module name; keep
+            # only the last path per module, as the serial loop did, so
+            # no two threads refresh the same Module concurrently.
+            refreshes[self.modules[name]] = path
+
+        # Each file is read and scanned independently; fan the refreshes
+        # out over a thread pool and apply the results in order.
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            results = pool.map(lambda job: job[0].refresh(job[1]), refreshes.items())
+
+            for module, ok in zip(refreshes, results):
+                if not ok:
+                    self.modules.pop(module.name, None)
 
     def disable(self, excluded):
-        for exclude in excluded:
-            for module in self.modules.values():
-                name = module.clean_name()
-                if name.startswith(exclude):
-                    module.enabled = False
-                    module.modified = True
+        if not excluded:
+            return
+
+        for module in self.modules.values():
+            name = module.clean_name()
+            if any(name.startswith(exclude) for exclude in excluded):
+                module.enabled = False
+                module.modified = True
 
     def suite_count(self):
         return len(self.modules)
@@ -198,25 +265,30 @@ class TestSuite(object):
         if not self.should_generate(output):
             return False
 
-        with open(output, 'w') as data:
-            for module in self.modules.values():
-                t = Module.DeclarationTemplate(module)
-                data.write(t.render())
+        tmp_output = output + '.tmp'
+
+        with open(tmp_output, 'w') as data:
+            data.writelines(Module.DeclarationTemplate(module).render()
+                            for module in self.modules.values())
 
-            for module in self.modules.values():
-                t = Module.CallbacksTemplate(module)
-                data.write(t.render())
+            data.writelines(Module.CallbacksTemplate(module).render()
+                            for module in self.modules.values())
 
-            suites = "static struct clar_suite _clar_suites[] = {" + ','.join(
-                Module.InfoTemplate(module).render() for module in self.modules.values()
-            ) + "};"
+            data.write("static struct clar_suite _clar_suites[] = {")
 
-            data.write(suites)
+            for i, module in enumerate(self.modules.values()):
+                if i > 0:
+                    data.write(",")
+                data.write(Module.InfoTemplate(module).render())
+
+            data.write("};")
 
             data.write("static const size_t _clar_suite_count = %d;" % self.suite_count())
             data.write("static const size_t _clar_callback_count = %d;" % self.callback_count())
 
-        suite.save_cache()
+        os.replace(tmp_output, output)
+
+        self.save_cache()
         return True
 
 if __name__ == '__main__':
@@ -233,5 +305,5 @@ if __name__ == '__main__':
         suite.load(options.force)
         suite.disable(options.excluded)
         if suite.write():
-            print "Written `clar.suite` (%d suites)" % len(suite.modules)
+            print("Written `clar.suite` (%d suites)" % len(suite.modules))
 